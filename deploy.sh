@@ -14,13 +14,6 @@ kubectl apply -f k8s/rbac.yaml
 echo "Applying ConfigMap..."
 kubectl apply -f k8s/configmap.yaml
 
-echo "Deploying KubeGuard..."
-kubectl apply -f k8s/deployment.yaml
-kubectl apply -f k8s/service.yaml
-
-echo "Waiting for deployment to be ready..."
-kubectl wait --for=condition=available --timeout=300s deployment/kube-guard -n kube-guard
-
 echo "Creating TLS certificate for webhook..."
 # Generate a private key
 openssl genrsa -out webhook.key 2048
@@ -70,6 +63,13 @@ kubectl get csr kube-guard-webhook -o jsonpath='{.status.certificate}' | base64
 echo "Creating TLS secret..."
 kubectl create secret tls kube-guard-tls --cert=webhook.crt --key=webhook.key -n kube-guard --dry-run=client -o yaml | kubectl apply -f -
 
+echo "Deploying KubeGuard..."
+kubectl apply -f k8s/deployment.yaml
+kubectl apply -f k8s/service.yaml
+
+echo "Waiting for deployment to be ready..."
+kubectl wait --for=condition=available --timeout=300s deployment/kube-guard -n kube-guard
+
 # Get CA bundle
 CA_BUNDLE=$(kubectl get configmap -n kube-system extension-apiserver-authentication -o=jsonpath='{.data.client-ca-file}' | base64 | tr -d '\n')
 
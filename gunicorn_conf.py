@@ -0,0 +1,21 @@
+# Gunicorn configuration for KubeGuard
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8443')}"
+
+# gevent workers give per-core parallelism plus per-worker concurrency
+worker_class = 'gevent'
+workers = int(os.getenv('WEB_CONCURRENCY', os.cpu_count() or 1))
+worker_connections = 1000
+keepalive = 75
+
+# The root filesystem is read-only, so keep worker heartbeat files in memory
+worker_tmp_dir = '/dev/shm'
+
+certfile = os.getenv('TLS_CERT', '/etc/tls/tls.crt')
+keyfile = os.getenv('TLS_KEY', '/etc/tls/tls.key')
+
+# The API server only talks HTTPS to webhooks, so refuse to start without a certificate
+if not (os.path.exists(certfile) and os.path.exists(keyfile)):
+    raise SystemExit(f"TLS certificate not found, expected {certfile} and {keyfile} "
+                     "(mount the webhook TLS secret at /etc/tls or set TLS_CERT/TLS_KEY)")
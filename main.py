@@ -1,26 +1,121 @@
 #!/usr/bin/env python3
 
-import json
+# Must run before requests/flask/kubernetes are imported so their sockets cooperate
+from gevent import monkey
+monkey.patch_all()
+
+import time
+import collections
 import yaml
+import orjson
 import logging
 import requests
-import base64
-from datetime import datetime
-from flask import Flask, request, jsonify
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import atexit
+import threading
+import concurrent.futures
+from flask import Flask, request
+from gevent.pywsgi import WSGIServer
 from kubernetes import client, config
+from kubernetes.watch.watch import iter_resp_lines
 import os
+import sys
+
+try:
+    from yaml import CSafeLoader
+except ImportError:
+    from yaml import SafeLoader as CSafeLoader
 
 app = Flask(__name__)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-logger.info(f"DEBUG: Module loading, __name__ = {__name__}")
+# base64.b64encode(b'[]'), the empty JSONPatch returned by /mutate
+_EMPTY_PATCH_B64 = 'W10='
+
+# Admission kind -> (notification setting, alert title, action description)
+_ALERT_KINDS = {
+    'PodExecOptions': ('shell_access', 'Shell Access Alert', 'opened a shell'),
+    'PodPortForwardOptions': ('port_forward', 'Port Forward Alert', 'created a port-forward')
+}
+
+_TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S UTC'
+
+# The API server ends each ConfigMap watch after this long; the client gives up a bit later
+# so a dead connection can't stall config reloads forever
+_WATCH_TIMEOUT_SECONDS = 300
+_WATCH_REQUEST_TIMEOUT = _WATCH_TIMEOUT_SECONDS + 30
+
+# Stop calling Mattermost for a while after this many consecutive failures
+_CB_FAILURE_THRESHOLD = 5
+_CB_OPEN_SECONDS = 30
+
+# Identical alerts within this window are dropped; bursts are posted as one message
+_DEDUP_SECONDS = 5
+_DEDUP_MAX_ENTRIES = 10000
+_BATCH_SECONDS = 2
+_BATCH_MAX_MESSAGES = 20
+
+# AdmissionReview allowing the request; only the JSON-encoded uid varies
+_VALIDATE_OK = (b'{"apiVersion":"admission.k8s.io/v1","kind":"AdmissionReview",'
+                b'"response":{"uid":%b,"allowed":true}}')
+
+# Same as _VALIDATE_OK, plus the empty JSONPatch the mutating webhook returns
+_MUTATE_OK = (b'{"apiVersion":"admission.k8s.io/v1","kind":"AdmissionReview",'
+              b'"response":{"uid":%b,"allowed":true,"patchType":"JSONPatch",'
+              b'"patch":"' + _EMPTY_PATCH_B64.encode() + b'"}}')
+
+# Configuration plus the fields derived from it, swapped in as one object
+ConfigSnapshot = collections.namedtuple(
+    'ConfigSnapshot',
+    ['config_data', 'webhook_url', 'mm_channel', 'monitored_ns', 'notify', 'handlers']
+)
+
+logger.debug("Module loading, __name__ = %s", __name__)
 
 class KubeGuardController:
     def __init__(self):
-        self.config_data = {}
+        self.config_map_name = os.getenv('CONFIG_MAP_NAME', 'kube-guard-config')
+        self.config_map_namespace = os.getenv('CONFIG_MAP_NAMESPACE', 'kube-guard')
+        self._resource_version = None
+        self.apply_config({})
+        self.http = self.create_http_session()
+        self._cb_lock = threading.Lock()
+        self._cb_fail_count = 0
+        self._cb_open_until = 0.0
+        self._batch_lock = threading.Lock()
+        self._recent = collections.OrderedDict()
+        self._pending = []
+        self.notify_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=8,
+            thread_name_prefix='mm-notify'
+        )
+        # Bounds the number of queued notifications so a Mattermost outage sheds load
+        self.notify_slots = threading.BoundedSemaphore(256)
+        atexit.register(self.notify_executor.shutdown, wait=False)
         self.load_kubernetes_config()
         self.load_config()
+        self.start_config_watch()
+
+    def create_http_session(self):
+        """Create a pooled HTTP session for outgoing notifications"""
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=10,
+            pool_maxsize=50,
+            max_retries=Retry(
+                total=2,
+                connect=1,
+                read=1,
+                backoff_factor=0.1,
+                status_forcelist=(500, 502, 503, 504),
+                allowed_methods=frozenset(['POST'])
+            )
+        )
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
 
     def load_kubernetes_config(self):
         """Load Kubernetes configuration"""
@@ -32,7 +127,7 @@ class KubeGuardController:
                 config.load_kube_config()
                 logger.info("Loaded local Kubernetes config")
             except Exception as e:
-                logger.error(f"Failed to load Kubernetes config: {e}")
+                logger.error("Failed to load Kubernetes config: %s", e)
                 raise
 
         self.k8s_client = client.CoreV1Api()
@@ -40,22 +135,22 @@ class KubeGuardController:
     def load_config(self):
         """Load configuration from ConfigMap"""
         try:
-            config_map_name = os.getenv('CONFIG_MAP_NAME', 'kube-guard-config')
-            config_map_namespace = os.getenv('CONFIG_MAP_NAMESPACE', 'kube-guard')
-
-            config_map = self.k8s_client.read_namespaced_config_map(
-                name=config_map_name,
-                namespace=config_map_namespace
+            # Read the raw JSON; only config.yaml is needed, so skip building V1ConfigMap models
+            response = self.k8s_client.read_namespaced_config_map(
+                name=self.config_map_name,
+                namespace=self.config_map_namespace,
+                _preload_content=False
             )
+            config_map = orjson.loads(response.data)
 
-            config_yaml = config_map.data.get('config.yaml', '{}')
-            self.config_data = yaml.safe_load(config_yaml)
+            self.apply_config(self.parse_config_map(config_map))
+            self._resource_version = config_map['metadata'].get('resourceVersion')
             logger.info("Configuration loaded successfully")
 
         except Exception as e:
-            logger.error(f"Failed to load config from ConfigMap: {e}")
+            logger.error("Failed to load config from ConfigMap: %s", e)
             # Fallback to default config
-            self.config_data = {
+            self.apply_config({
                 'mattermost': {
                     'webhook_url': os.getenv('MATTERMOST_WEBHOOK_URL', ''),
                     'channel': os.getenv('MATTERMOST_CHANNEL', 'alerts')
@@ -65,171 +160,317 @@ class KubeGuardController:
                     'shell_access': True,
                     'port_forward': True
                 }
-            }
+            })
+
+    def parse_config_map(self, config_map):
+        """Parse the config.yaml entry of a raw ConfigMap dict"""
+        config_yaml = (config_map.get('data') or {}).get('config.yaml', '{}')
+        if config_yaml.lstrip().startswith('{'):
+            # JSON is valid YAML, and orjson parses it much faster
+            try:
+                return orjson.loads(config_yaml) or {}
+            except orjson.JSONDecodeError:
+                pass
+        return yaml.load(config_yaml, Loader=CSafeLoader) or {}
+
+    def apply_config(self, config_data):
+        """Swap in new configuration and precompute the fields used per request"""
+        self._config = self.build_config_snapshot(config_data)
+
+    def build_config_snapshot(self, config_data):
+        """Validate configuration and derive the per-request fields, raising ValueError if malformed"""
+        if config_data is None:
+            config_data = {}
+        if not isinstance(config_data, dict):
+            raise ValueError("config.yaml must be a mapping")
+
+        mattermost = config_data.get('mattermost') or {}
+        notifications = config_data.get('notifications') or {}
+        if not isinstance(mattermost, dict) or not isinstance(notifications, dict):
+            raise ValueError("'mattermost' and 'notifications' must be mappings")
+
+        # Bake the cluster name into each alert so only per-request fields are formatted later
+        cluster_name = config_data.get('cluster_name', 'in-cluster')
+        cluster = str(cluster_name).replace('{', '{{').replace('}', '}}')
+        handlers = {
+            kind: (setting, (f":warning: **{title}** on cluster `{cluster}`\n"
+                             f"User `{{user}}` {action} to pod `{{ns}}/{{pod}}`\n"
+                             f"Time: {{ts}}"))
+            for kind, (setting, title, action) in _ALERT_KINDS.items()
+        }
+
+        return ConfigSnapshot(
+            config_data=config_data,
+            webhook_url=mattermost.get('webhook_url'),
+            mm_channel=f"#{mattermost.get('channel', 'alerts')}",
+            monitored_ns=config_data.get('monitored_namespace', 'my-namespace'),
+            notify={
+                'shell_access': notifications.get('shell_access', True),
+                'port_forward': notifications.get('port_forward', True)
+            },
+            handlers=handlers
+        )
+
+    def start_config_watch(self):
+        """Start a background thread that keeps the ConfigMap snapshot up to date"""
+        watcher = threading.Thread(target=self.watch_config, name='config-watch', daemon=True)
+        watcher.start()
+
+    def watch_config(self):
+        """Watch the ConfigMap and reload configuration when it changes"""
+        while True:
+            try:
+                response = self.k8s_client.list_namespaced_config_map(
+                    namespace=self.config_map_namespace,
+                    field_selector=f'metadata.name={self.config_map_name}',
+                    resource_version=self._resource_version,
+                    timeout_seconds=_WATCH_TIMEOUT_SECONDS,
+                    watch=True,
+                    _preload_content=False,
+                    _request_timeout=_WATCH_REQUEST_TIMEOUT
+                )
+                try:
+                    for line in iter_resp_lines(response):
+                        self.handle_config_event(orjson.loads(line))
+                finally:
+                    response.release_conn()
+
+            except Exception as e:
+                logger.error("ConfigMap watch failed, restarting: %s", e)
+                # Resource version may have expired, resync from a fresh list
+                self._resource_version = None
+                time.sleep(5)
+
+    def handle_config_event(self, event):
+        """Apply a single raw ConfigMap watch event"""
+        event_type = event['type']
+        config_map = event['object']
+
+        if event_type == 'ERROR':
+            raise RuntimeError(config_map.get('message', 'watch error'))
+
+        self._resource_version = config_map['metadata'].get('resourceVersion')
+
+        if event_type in ('ADDED', 'MODIFIED'):
+            try:
+                self.apply_config(self.parse_config_map(config_map))
+            except Exception as e:
+                # Keep the last known good configuration; the resource version has
+                # already advanced, so the bad revision isn't replayed on reconnect
+                logger.error("Invalid configuration in ConfigMap, keeping last known configuration: %s", e)
+                return
+            logger.info("Configuration reloaded from ConfigMap")
+        elif event_type == 'DELETED':
+            # Keep the last known good configuration
+            logger.warning("ConfigMap deleted, keeping last known configuration")
 
     def send_mattermost_notification(self, message, username='KubeGuard'):
         """Send notification to Mattermost"""
-        webhook_url = self.config_data.get('mattermost', {}).get('webhook_url')
-        channel = self.config_data.get('mattermost', {}).get('channel', 'alerts')
+        cfg = self._config
+        webhook_url = cfg.webhook_url
 
         if not webhook_url:
             logger.warning("Mattermost webhook URL not configured")
             return
 
+        if time.monotonic() < self._cb_open_until:
+            logger.warning("Mattermost circuit breaker open, skipping notification")
+            return
+
         payload = {
-            'channel': f"#{channel}",
+            'channel': cfg.mm_channel,
             'username': username,
             'text': message,
             'icon_emoji': ':warning:'
         }
 
         try:
-            response = requests.post(webhook_url, json=payload, timeout=10)
+            response = self.http.post(webhook_url, json=payload, timeout=(3.05, 10))
             response.raise_for_status()
             logger.info("Notification sent to Mattermost successfully")
+            with self._cb_lock:
+                self._cb_fail_count = 0
         except Exception as e:
-            logger.error(f"Failed to send Mattermost notification: {e}")
+            logger.error("Failed to send Mattermost notification: %s", e)
+            with self._cb_lock:
+                self._cb_fail_count += 1
+                if self._cb_fail_count >= _CB_FAILURE_THRESHOLD:
+                    self._cb_open_until = time.monotonic() + _CB_OPEN_SECONDS
+                    self._cb_fail_count = 0
+                    logger.warning("Mattermost unreachable, pausing notifications for %ss", _CB_OPEN_SECONDS)
+
+    def queue_mattermost_notification(self, message):
+        """Hand a notification to the background executor without blocking"""
+        if not self.notify_slots.acquire(blocking=False):
+            logger.warning("Notification queue full, dropping Mattermost notification")
+            return
 
-    def is_shell_access(self, admission_request):
-        """Check if the request is for shell access (exec)"""
-        resource = admission_request.get('kind', {})
-        if resource.get('kind') != 'PodExecOptions':
+        try:
+            future = self.notify_executor.submit(self.send_mattermost_notification, message)
+        except Exception:
+            self.notify_slots.release()
+            raise
+        future.add_done_callback(lambda _: self.notify_slots.release())
+
+    def batch_mattermost_notification(self, message):
+        """Collect a notification so a burst of alerts is posted together"""
+        with self._batch_lock:
+            self._pending.append(message)
+            if len(self._pending) > 1:
+                return
+
+        timer = threading.Timer(_BATCH_SECONDS, self.flush_notifications)
+        timer.daemon = True
+        try:
+            timer.start()
+        except Exception as e:
+            # Without a timer nothing would ever drain _pending, so send the batch now
+            logger.error("Failed to schedule notification flush, sending immediately: %s", e)
+            self.flush_notifications()
+
+    def flush_notifications(self):
+        """Queue the collected notifications as combined Mattermost messages"""
+        with self._batch_lock:
+            messages, self._pending = self._pending, []
+
+        for i in range(0, len(messages), _BATCH_MAX_MESSAGES):
+            self.queue_mattermost_notification('\n\n'.join(messages[i:i + _BATCH_MAX_MESSAGES]))
+
+    def is_duplicate(self, key):
+        """Check whether the same alert was raised recently, remembering it if not"""
+        now = time.monotonic()
+        with self._batch_lock:
+            last_seen = self._recent.get(key)
+            if last_seen is not None and now - last_seen < _DEDUP_SECONDS:
+                return True
+
+            self._recent[key] = now
+            self._recent.move_to_end(key)
+            if len(self._recent) > _DEDUP_MAX_ENTRIES:
+                self._recent.popitem(last=False)
             return False
 
-        namespace = admission_request.get('namespace', '')
-        return namespace == self.config_data.get('monitored_namespace', 'my-namespace')
+    def process_admission_request(self, admission_request):
+        """Process the admission request and send notifications if needed"""
+        req = admission_request
+        kind = (req.get('kind') or {}).get('kind')
+        cfg = self._config
+        handler = cfg.handlers.get(kind)
+        if handler is None:
+            return
 
-    def is_port_forward(self, admission_request):
-        """Check if the request is for port forwarding"""
-        resource = admission_request.get('kind', {})
-        if resource.get('kind') != 'PodPortForwardOptions':
-            return False
+        setting, template = handler
+        namespace = req.get('namespace', '')
+        if namespace != cfg.monitored_ns or not cfg.notify[setting]:
+            return
 
-        namespace = admission_request.get('namespace', '')
-        return namespace == self.config_data.get('monitored_namespace', 'my-namespace')
+        user = (req.get('userInfo') or {}).get('username', 'unknown')
+        pod = req.get('name', 'unknown')
+        # A single kubectl exec can produce several admission requests
+        if self.is_duplicate((user, namespace, pod, kind)):
+            return
 
-    def get_user_info(self, admission_request):
-        """Extract user information from the admission request"""
-        user_info = admission_request.get('userInfo', {})
-        username = user_info.get('username', 'unknown')
-        groups = user_info.get('groups', [])
-        return username, groups
+        self.batch_mattermost_notification(template.format(
+            user=user,
+            ns=namespace,
+            pod=pod,
+            ts=time.strftime(_TIMESTAMP_FORMAT, time.gmtime())
+        ))
 
-    def process_admission_request(self, admission_request):
-        """Process the admission request and send notifications if needed"""
-        try:
-            username, groups = self.get_user_info(admission_request)
-            namespace = admission_request.get('namespace', '')
-            resource = admission_request.get('kind', {}).get('kind', '')
-            cluster_name = self.config_data.get('cluster_name','in-cluster')
-
-            message = None
-
-            if self.is_shell_access(admission_request):
-                if self.config_data.get('notifications', {}).get('shell_access', True):
-                    pod_name = admission_request.get('name', 'unknown')
-                    message = (f":warning: **Shell Access Alert** on cluster `{cluster_name}`\n"
-                             f"User `{username}` opened a shell to pod `{namespace}/{pod_name}`\n"
-                             f"Time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S UTC')}")
-
-            elif self.is_port_forward(admission_request):
-                if self.config_data.get('notifications', {}).get('port_forward', True):
-                    pod_name = admission_request.get('name', 'unknown')
-                    message = (f":warning: **Port Forward Alert** on cluster `{cluster_name}\n"
-                             f"User `{username}` created a port-forward to pod `{namespace}/{pod_name}`\n"
-                             f"Time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S UTC')}")
-
-            if message:
-                self.send_mattermost_notification(message)
+def json_response(obj, status=200):
+    """Serialize obj with orjson into a Flask response"""
+    return app.response_class(orjson.dumps(obj), status=status, mimetype='application/json')
 
-        except Exception as e:
-            logger.error(f"Error processing admission request: {e}")
+def allow_response(uid, template=_VALIDATE_OK):
+    """Build an AdmissionReview response allowing the request with the given uid"""
+    return app.response_class(template % orjson.dumps(uid), mimetype='application/json')
+
+# Probe responses never change, so build them once and reuse them
+_HEALTHY = app.response_class(b'{"status":"healthy"}', mimetype='application/json')
+_READY = app.response_class(b'{"status":"ready"}', mimetype='application/json')
+_NOT_READY = app.response_class(b'{"status":"not ready"}', status=503, mimetype='application/json')
 
 # Global controller instance
 try:
     controller = KubeGuardController()
 except Exception as e:
-    logger.warning(f"Failed to initialize KubeGuardController: {e}")
+    logger.warning("Failed to initialize KubeGuardController: %s", e)
     controller = None
 
 @app.route('/healthz', methods=['GET'])
 def health_check():
     """Health check endpoint"""
-    return jsonify({'status': 'healthy'}), 200
+    return _HEALTHY
 
 @app.route('/readyz', methods=['GET'])
 def readiness_check():
     """Readiness check endpoint"""
-    return jsonify({'status': 'ready'}), 200
+    # The controller always applies a configuration (loaded or default) on startup
+    if controller is not None:
+        return _READY
+    return _NOT_READY
 
 @app.route('/validate', methods=['POST'])
 def validate():
     """Validation webhook endpoint"""
     try:
-        admission_review = request.get_json()
+        admission_review = orjson.loads(request.get_data(cache=False))
 
         if not admission_review or 'request' not in admission_review:
-            return jsonify({'error': 'Invalid admission review'}), 400
+            return json_response({'error': 'Invalid admission review'}, 400)
 
         admission_request = admission_review['request']
 
-        # Process the request for notifications (this doesn't block the request)
-        controller.process_admission_request(admission_request)
+        # Most admission requests are kinds we never alert on; allow them straight away
+        kind = (admission_request.get('kind') or {}).get('kind')
+        if kind not in _ALERT_KINDS:
+            return allow_response(admission_request.get('uid'))
 
-        # Always allow the request (we're just monitoring, not blocking)
-        admission_response = {
-            'uid': admission_request.get('uid'),
-            'allowed': True
-        }
+        # Process the request for notifications (this doesn't block the request).
+        # We only monitor, so a notification failure must never deny the request.
+        if controller is not None:
+            try:
+                controller.process_admission_request(admission_request)
+            except Exception as e:
+                logger.error("Error processing admission request: %s", e)
 
-        return jsonify({
-            'apiVersion': 'admission.k8s.io/v1',
-            'kind': 'AdmissionReview',
-            'response': admission_response
-        })
+        # Always allow the request (we're just monitoring, not blocking)
+        return allow_response(admission_request.get('uid'))
 
     except Exception as e:
-        logger.error(f"Error in validation webhook: {e}")
-        return jsonify({'error': str(e)}), 500
+        logger.error("Error in validation webhook: %s", e)
+        return json_response({'error': str(e)}, 500)
 
 @app.route('/mutate', methods=['POST'])
 def mutate():
     """Mutation webhook endpoint (not used but required for completeness)"""
     try:
-        admission_review = request.get_json()
+        admission_review = orjson.loads(request.get_data(cache=False))
         admission_request = admission_review['request']
 
         # No mutations, just allow (notification handled by /validate endpoint)
-        admission_response = {
-            'uid': admission_request.get('uid'),
-            'allowed': True,
-            'patchType': 'JSONPatch',
-            'patch': base64.b64encode(json.dumps([]).encode()).decode()
-        }
-
-        return jsonify({
-            'apiVersion': 'admission.k8s.io/v1',
-            'kind': 'AdmissionReview',
-            'response': admission_response
-        })
+        return allow_response(admission_request.get('uid'), _MUTATE_OK)
 
     except Exception as e:
-        logger.error(f"Error in mutation webhook: {e}")
-        return jsonify({'error': str(e)}), 500
+        logger.error("Error in mutation webhook: %s", e)
+        return json_response({'error': str(e)}, 500)
 
 if __name__ == '__main__':
-    logger.info(f"DEBUG: Entering __main__ block, __name__ = {__name__}")
+    logger.debug("Entering __main__ block, __name__ = %s", __name__)
     port = int(os.getenv('PORT', 8443))
 
     # Check if TLS certificates are mounted
-    tls_cert_path = '/etc/tls/tls.crt'
-    tls_key_path = '/etc/tls/tls.key'
-
-    if os.path.exists(tls_cert_path) and os.path.exists(tls_key_path):
-        logger.info("Using mounted TLS certificates")
-        ssl_context = (tls_cert_path, tls_key_path)
-    else:
-        logger.info("Using adhoc TLS certificates")
-        ssl_context = 'adhoc'
-
-    app.run(host='0.0.0.0', port=port, ssl_context=ssl_context)
+    tls_cert_path = os.getenv('TLS_CERT', '/etc/tls/tls.crt')
+    tls_key_path = os.getenv('TLS_KEY', '/etc/tls/tls.key')
+
+    # Local development server; the container runs gunicorn with gunicorn_conf.py.
+    # Serve with gevent so blocking I/O in one webhook doesn't serialize the others.
+    # Keep route handlers synchronous; Flask async views don't mix with gevent.
+    if not (os.path.exists(tls_cert_path) and os.path.exists(tls_key_path)):
+        logger.error("TLS certificate not found, expected %s and %s "
+                     "(mount the webhook TLS secret at /etc/tls or set TLS_CERT/TLS_KEY)",
+                     tls_cert_path, tls_key_path)
+        sys.exit(1)
+
+    logger.info("Using mounted TLS certificates")
+    WSGIServer(('0.0.0.0', port), app, keyfile=tls_key_path, certfile=tls_cert_path).serve_forever()